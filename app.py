@@ -1,24 +1,32 @@
 # -*- coding: utf-8 -*-
 import concurrent.futures as cf
 import glob
+import hashlib
 import io
+import multiprocessing
 import os
+import threading
 import time
+from collections import OrderedDict, deque
+from functools import lru_cache
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import List, Literal
 
+import fitz
 import gradio as gr
 
 from loguru import logger
 from openai import OpenAI
 from promptic import llm
-from pydantic import BaseModel, ValidationError
-from pypdf import PdfReader
+from pydantic import ValidationError
 from tenacity import retry, retry_if_exception_type
 
 import re
 
+from data_structs.dialogue_models import Dialogue
+from utils import pdf_text
+from utils.models import STANDARD_AUDIO_MODELS, STANDARD_TEXT_MODELS, STANDARD_VOICES
+
 def read_readme():
     readme_path = Path("README.md")
     if readme_path.exists():
@@ -427,73 +435,45 @@ O podcast deve ter cerca de 20.000 palavras.
     },
 }
 
+# Instruction fields per template, flattened once in the order the UI textboxes expect
+INSTRUCTION_FIELDS = {
+    key: (
+        template["intro"],
+        template["text_instructions"],
+        template["scratch_pad"],
+        template["prelude"],
+        template["dialog"],
+    )
+    for key, template in INSTRUCTION_TEMPLATES.items()
+}
+
 # Function to update instruction fields based on template selection
 def update_instructions(template):
-    return (
-        INSTRUCTION_TEMPLATES[template]["intro"],
-        INSTRUCTION_TEMPLATES[template]["text_instructions"],
-        INSTRUCTION_TEMPLATES[template]["scratch_pad"],
-        INSTRUCTION_TEMPLATES[template]["prelude"],
-        INSTRUCTION_TEMPLATES[template]["dialog"]
-           )
-
-import concurrent.futures as cf
-import glob
-import io
-import os
-import time
-from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import List, Literal
-
-import gradio as gr
-
-from loguru import logger
-from openai import OpenAI
-from promptic import llm
-from pydantic import BaseModel, ValidationError
-from pypdf import PdfReader
-from tenacity import retry, retry_if_exception_type
-
-# Define standard values
-STANDARD_TEXT_MODELS = [
-    "o1-preview-2024-09-12",
-    "o1-preview",
-    "gpt-4o-2024-08-06",
-    "gpt-4o-mini",
-    "o1-mini-2024-09-12",
-    "o1-mini",
-    "chatgpt-4o-latest",
-    "gpt-4-turbo",
-    "openai/custom_model",
-]
-
-STANDARD_AUDIO_MODELS = [
-    "tts-1",
-    "tts-1-hd",
-]
-
-STANDARD_VOICES = [
-    "alloy",
-    "echo",
-    "fable",
-    "onyx",
-    "nova",
-    "shimmer",
-]
-
-class DialogueItem(BaseModel):
-    text: str
-    speaker: Literal["speaker-1", "speaker-2"]
-
-class Dialogue(BaseModel):
-    scratchpad: str
-    dialogue: List[DialogueItem]
+    return INSTRUCTION_FIELDS[template]
+
+# Read once at startup; a key entered in the UI takes precedence
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# TTS requests are network-bound, so fan out wider than the CPU-based default thread count.
+# Each request keeps at most TTS_CONCURRENCY lines in flight, so one long podcast can't queue its
+# whole dialogue ahead of other users on the shared pool.
+TTS_CONCURRENCY = 20
+# One pool is shared by all requests so worker threads are reused instead of spawned per podcast.
+TTS_POOL_SIZE = int(os.getenv("TTS_POOL_SIZE", "64"))
+TTS_POOL = cf.ThreadPoolExecutor(max_workers=TTS_POOL_SIZE, thread_name_prefix="tts")
+# The OpenAI client retries connection errors, 429s and 5xx responses with exponential backoff
+TTS_MAX_RETRIES = 5
+
+# One client per API key, so TTS calls reuse its pooled keep-alive connections instead of a TLS handshake per line
+@lru_cache(maxsize=32)
+def get_openai_client(api_key: str) -> OpenAI:
+    return OpenAI(
+        api_key=api_key,
+        max_retries=TTS_MAX_RETRIES,
+    )
 
 def get_mp3(text: str, voice: str, audio_model: str, api_key: str = None) -> bytes:
-    client = OpenAI(
-        api_key=api_key or os.getenv("OPENAI_API_KEY"),
-    )
+    client = get_openai_client(api_key or OPENAI_API_KEY)
 
     with client.audio.speech.with_streaming_response.create(
         model=audio_model,
@@ -505,8 +485,201 @@ def get_mp3(text: str, voice: str, audio_model: str, api_key: str = None) -> byt
                 file.write(chunk)
             return file.getvalue()
 
+# Bounds on the extracted text sent to the LLM
+MIN_TEXT_CHARS = 200
+MAX_TEXT_CHARS = 200_000
+
+# Uploads with fewer pages than this in total are parsed inline, where pool dispatch would cost more than it saves.
+# Larger uploads go to the process pool, and a single document at least this long is also split into page ranges.
+PDF_PARALLEL_MIN_PAGES = 200
+
+# One bounded process pool for PDF parsing, shared by all requests and started on first use.
+# Workers come from a forkserver (spawn where unavailable) rather than forking this multi-threaded process.
+PDF_POOL_SIZE = int(os.getenv("PDF_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def get_pdf_pool() -> cf.ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pdf_pool = cf.ProcessPoolExecutor(
+                max_workers=PDF_POOL_SIZE,
+                mp_context=multiprocessing.get_context(start_method),
+            )
+        return _pdf_pool
+
+def reset_pdf_pool(pool: cf.ProcessPoolExecutor) -> None:
+    # A worker crash (e.g. a malformed PDF taking down MuPDF) breaks the pool for good; replace it on next use
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# Extracted text per PDF keyed on the SHA-256 of its bytes, so re-uploads of the same document skip parsing
+PDF_TEXT_CACHE_MAXSIZE = 64
+_pdf_text_cache = OrderedDict()
+_pdf_text_cache_lock = threading.Lock()
+
+def get_cached_pdf_text(digest: str):
+    with _pdf_text_cache_lock:
+        text = _pdf_text_cache.get(digest)
+        if text is not None:
+            _pdf_text_cache.move_to_end(digest)
+        return text
+
+def cache_pdf_text(digest: str, text: str) -> None:
+    with _pdf_text_cache_lock:
+        _pdf_text_cache[digest] = text
+        _pdf_text_cache.move_to_end(digest)
+        while len(_pdf_text_cache) > PDF_TEXT_CACHE_MAXSIZE:
+            _pdf_text_cache.popitem(last=False)
+
+def extract_pdfs_text(files: list) -> str:
+    """
+    Extracts and concatenates the text of several PDFs, joining non-empty pages with blank lines.
+    Each file is read once and fingerprinted; identical documents are parsed once per request and
+    served from the cache afterwards. Misses are opened from memory. When they add up to enough pages,
+    they are parsed on the shared PDF process pool: one task per short document, and one page range
+    per pool worker for a long one. PyMuPDF holds the GIL and is not thread-safe, so each worker opens
+    its own document.
+    """
+    digests = []
+    texts = {}
+    misses = []
+    pending_pages = {}
+    futures = []
+    pool = None
+    try:
+        for file in files:
+            data = Path(file).read_bytes()
+            digest = hashlib.sha256(data).hexdigest()
+            digests.append(digest)
+            if digest in texts or digest in pending_pages:
+                continue
+
+            cached = get_cached_pdf_text(digest)
+            if cached is not None:
+                texts[digest] = cached
+                continue
+
+            pending_pages[digest] = []
+            misses.append((digest, file, fitz.open(stream=data, filetype="pdf")))
+
+        if sum(doc.page_count for _, _, doc in misses) < PDF_PARALLEL_MIN_PAGES:
+            for digest, _, doc in misses:
+                pending_pages[digest] = pdf_text.pages_text(doc, 0, doc.page_count)
+        else:
+            pool = get_pdf_pool()
+            for digest, file, doc in misses:
+                page_count = doc.page_count
+                if page_count < PDF_PARALLEL_MIN_PAGES:
+                    ranges = [(0, page_count)]
+                else:
+                    step = -(-page_count // PDF_POOL_SIZE)
+                    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+                for start, stop in ranges:
+                    futures.append((digest, pool.submit(pdf_text.extract_pages_text, file, start, stop)))
+
+            # Ranges were submitted in page order, so extending per document keeps page order
+            for digest, future in futures:
+                pending_pages[digest].extend(future.result())
+    except cf.BrokenExecutor:
+        reset_pdf_pool(pool)
+        raise
+    except BaseException:
+        for _, future in futures:
+            future.cancel()
+        raise
+    finally:
+        for _, _, doc in misses:
+            doc.close()
+
+    for digest, pages in pending_pages.items():
+        texts[digest] = "\n\n".join(pages)
+        cache_pdf_text(digest, texts[digest])
+
+    return "".join(texts[digest] + "\n\n" for digest in digests)
+
+# Generated dialogues keyed on a hash of everything that goes into the prompt, so identical re-runs skip the LLM call.
+# Identical requests that arrive while the first one is still generating wait for it instead of calling the LLM again.
+DIALOGUE_CACHE_MAXSIZE = 64
+_dialogue_cache = OrderedDict()
+_dialogue_inflight = {}
+_dialogue_cache_lock = threading.Lock()
+
+def dialogue_cache_key(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def get_or_generate_dialogue(key: str, generate):
+    with _dialogue_cache_lock:
+        if key in _dialogue_cache:
+            _dialogue_cache.move_to_end(key)
+            logger.info("Reusing cached dialogue for identical input")
+            return _dialogue_cache[key]
+        inflight = _dialogue_inflight.get(key)
+        if inflight is None:
+            future = _dialogue_inflight[key] = cf.Future()
+
+    if inflight is not None:
+        logger.info("Waiting for identical dialogue generation already in progress")
+        dialogue = inflight.result()
+        if dialogue is not None:
+            return dialogue
+        # The owner's request failed. Its error may be specific to its API key, so it is never handed
+        # to waiters; each one generates with its own settings instead.
+        logger.info("Identical dialogue generation failed, generating independently")
+        return generate()
 
-from functools import wraps
+    try:
+        dialogue = generate()
+    except BaseException:
+        with _dialogue_cache_lock:
+            del _dialogue_inflight[key]
+        future.set_result(None)
+        raise
+
+    with _dialogue_cache_lock:
+        del _dialogue_inflight[key]
+        _dialogue_cache[key] = dialogue
+        while len(_dialogue_cache) > DIALOGUE_CACHE_MAXSIZE:
+            _dialogue_cache.popitem(last=False)
+    future.set_result(dialogue)
+    return dialogue
+
+TEMPORARY_DIRECTORY = "./gradio_cached_examples/tmp/"
+os.makedirs(TEMPORARY_DIRECTORY, exist_ok=True)
+
+# Generated mp3s are swept at most once per interval rather than on every request
+TEMPORARY_FILE_MAX_AGE = 24 * 60 * 60
+TEMPORARY_CLEANUP_INTERVAL = 60 * 60
+_last_cleanup = 0.0
+_cleanup_lock = threading.Lock()
+
+def cleanup_temporary_files():
+    """
+    Deletes any files in the temp directory that end with .mp3 and are over a day old.
+    """
+    global _last_cleanup
+    now = time.time()
+    with _cleanup_lock:
+        if now - _last_cleanup < TEMPORARY_CLEANUP_INTERVAL:
+            return
+        _last_cleanup = now
+
+    for file in glob.iglob(f"{TEMPORARY_DIRECTORY}*.mp3"):
+        try:
+            if os.path.isfile(file) and now - os.path.getmtime(file) > TEMPORARY_FILE_MAX_AGE:
+                os.remove(file)
+        except FileNotFoundError:
+            # Removed concurrently
+            pass
 
 def conditional_llm(model, api_base=None, api_key=None):
     """
@@ -521,6 +694,39 @@ def conditional_llm(model, api_base=None, api_key=None):
             return llm(model=model, api_key=api_key)(func)
     return decorator
 
+# promptic parses the prompt template and signature whenever it wraps a function, so build each variant once
+@lru_cache(maxsize=32)
+def make_dialogue_generator(text_model: str, api_base: str = None, api_key: str = None):
+    @retry(retry=retry_if_exception_type(ValidationError))
+    @conditional_llm(model=text_model, api_base=api_base, api_key=api_key)
+    def generate_dialogue(text: str, intro_instructions: str, text_instructions: str, scratch_pad_instructions: str, 
+                          prelude_dialog: str, podcast_dialog_instructions: str,
+                          edited_transcript: str = None, user_feedback: str = None, ) -> Dialogue:
+        """
+        {intro_instructions}
+        
+        Here is the original input text:
+        
+        <input_text>
+        {text}
+        </input_text>
+
+        {text_instructions}
+        
+        <scratchpad>
+        {scratch_pad_instructions}
+        </scratchpad>
+        
+        {prelude_dialog}
+        
+        <podcast_dialogue>
+        {podcast_dialog_instructions}
+        </podcast_dialogue>
+        {edited_transcript}{user_feedback}
+        """
+
+    return generate_dialogue
+
 def generate_audio(
     files: list,
     openai_api_key: str = None,
@@ -540,47 +746,24 @@ def generate_audio(
     debug = False,
 ) -> tuple:
     # Validate API Key
-    if not os.getenv("OPENAI_API_KEY") and not openai_api_key:
+    if not OPENAI_API_KEY and not openai_api_key:
         raise gr.Error("OpenAI API key is required")
 
     combined_text = original_text or ""
 
     # If there's no original text, extract it from the uploaded files
     if not combined_text:
-        for file in files:
-            with Path(file).open("rb") as f:
-                reader = PdfReader(f)
-                text = "\n\n".join([page.extract_text() for page in reader.pages if page.extract_text()])
-                combined_text += text + "\n\n"
+        combined_text = extract_pdfs_text(files)
 
-    # Configure the LLM based on selected model and api_base
-    @retry(retry=retry_if_exception_type(ValidationError))
-    @conditional_llm(model=text_model, api_base=api_base, api_key=openai_api_key)
-    def generate_dialogue(text: str, intro_instructions: str, text_instructions: str, scratch_pad_instructions: str, 
-                          prelude_dialog: str, podcast_dialog_instructions: str,
-                          edited_transcript: str = None, user_feedback: str = None, ) -> Dialogue:
-        """
-        {intro_instructions}
-        
-        Here is the original input text:
-        
-        <input_text>
-        {text}
-        </input_text>
+    # Don't spend an LLM call on documents without usable text, and keep very long ones within a sane prompt size
+    if len(combined_text.strip()) < MIN_TEXT_CHARS:
+        raise gr.Error("The uploaded PDFs have insufficient extractable text (scanned documents are not supported)")
+    if len(combined_text) > MAX_TEXT_CHARS:
+        logger.warning(f"Truncating input text from {len(combined_text)} to {MAX_TEXT_CHARS} characters")
+        combined_text = combined_text[:MAX_TEXT_CHARS]
 
-        {text_instructions}
-        
-        <scratchpad>
-        {scratch_pad_instructions}
-        </scratchpad>
-        
-        {prelude_dialog}
-        
-        <podcast_dialogue>
-        {podcast_dialog_instructions}
-        </podcast_dialogue>
-        {edited_transcript}{user_feedback}
-        """
+    # Configure the LLM based on selected model and api_base
+    generate_dialogue = make_dialogue_generator(text_model, api_base, openai_api_key)
 
     instruction_improve='Based on the original text, please generate an improved version of the dialogue by incorporating the edits, comments and feedback.'
     edited_transcript_processed="\nPreviously generated edited transcript, with specific edits and comments that I want you to carefully address:\n"+"<edited_transcript>\n"+edited_transcript+"</edited_transcript>" if edited_transcript !="" else ""
@@ -593,8 +776,12 @@ def generate_audio(
         logger.info (edited_transcript_processed)
         logger.info (user_feedback_processed)
     
-    # Generate the dialogue using the LLM
-    llm_output = generate_dialogue(
+    # Generate the dialogue using the LLM, unless the exact same prompt was already answered
+    cache_key = dialogue_cache_key(
+        text_model, api_base, combined_text, intro_instructions, text_instructions, scratch_pad_instructions,
+        prelude_dialog, podcast_dialog_instructions, edited_transcript_processed, user_feedback_processed,
+    )
+    llm_output = get_or_generate_dialogue(cache_key, lambda: generate_dialogue(
         combined_text,
         intro_instructions=intro_instructions,
         text_instructions=text_instructions,
@@ -603,54 +790,93 @@ def generate_audio(
         podcast_dialog_instructions=podcast_dialog_instructions,
         edited_transcript=edited_transcript_processed,
         user_feedback=user_feedback_processed
-    )
+    ))
 
     # Generate audio from the transcript
-    audio = b""
-    transcript = ""
-    characters = 0
-
-    with cf.ThreadPoolExecutor() as executor:
-        futures = []
-        for line in llm_output.dialogue:
+    # Use a temporary file -- Gradio's audio component doesn't work with raw bytes in Safari.
+    # Chunks are written in dialogue order as they arrive, so the whole podcast is never held in memory.
+    temporary_file = NamedTemporaryFile(
+        dir=TEMPORARY_DIRECTORY,
+        delete=False,
+        suffix=".mp3",
+    )
+    futures = deque()
+    transcript_lines = []
+    characters = sum(len(line.text) for line in llm_output.dialogue)
+    lines = iter(llm_output.dialogue)
+
+    def submit_next_line():
+        line = next(lines, None)
+        if line is not None:
             transcript_line = f"{line.speaker}: {line.text}"
             voice = speaker_1_voice if line.speaker == "speaker-1" else speaker_2_voice
-            future = executor.submit(get_mp3, line.text, voice, audio_model, openai_api_key)
+            future = TTS_POOL.submit(get_mp3, line.text, voice, audio_model, openai_api_key)
             futures.append((future, transcript_line))
-            characters += len(line.text)
 
-        for future, transcript_line in futures:
-            audio_chunk = future.result()
-            audio += audio_chunk
-            transcript += transcript_line + "\n\n"
+    try:
+        with temporary_file:
+            # Keep a sliding window of TTS_CONCURRENCY lines in flight, refilled as chunks are written in order
+            for _ in range(TTS_CONCURRENCY):
+                submit_next_line()
+
+            while futures:
+                future, transcript_line = futures[0]
+                temporary_file.write(future.result())
+                transcript_lines.append(transcript_line + "\n\n")
+                futures.popleft()
+                submit_next_line()
+    except BaseException:
+        # The pool outlives this request, so drop its queued lines and don't leave a truncated mp3 behind
+        for future, _ in futures:
+            future.cancel()
+        os.remove(temporary_file.name)
+        raise
+
+    transcript = "".join(transcript_lines)
 
     logger.info(f"Generated {characters} characters of audio")
 
-    temporary_directory = "./gradio_cached_examples/tmp/"
-    os.makedirs(temporary_directory, exist_ok=True)
-
-    # Use a temporary file -- Gradio's audio component doesn't work with raw bytes in Safari
-    temporary_file = NamedTemporaryFile(
-        dir=temporary_directory,
-        delete=False,
-        suffix=".mp3",
-    )
-    temporary_file.write(audio)
-    temporary_file.close()
-
-    # Delete any files in the temp directory that end with .mp3 and are over a day old
-    for file in glob.glob(f"{temporary_directory}*.mp3"):
-        if os.path.isfile(file) and time.time() - os.path.getmtime(file) > 24 * 60 * 60:
-            os.remove(file)
+    cleanup_temporary_files()
 
     return temporary_file.name, transcript, combined_text
 
-def validate_and_generate_audio(*args):
-    files = args[0]
+def validate_and_generate_audio(
+    files: list,
+    openai_api_key: str = None,
+    text_model: str = "o1-preview-2024-09-12",
+    audio_model: str = "tts-1",
+    speaker_1_voice: str = "alloy",
+    speaker_2_voice: str = "echo",
+    api_base: str = None,
+    intro_instructions: str = '',
+    text_instructions: str = '',
+    scratch_pad_instructions: str = '',
+    prelude_dialog: str = '',
+    podcast_dialog_instructions: str = '',
+    edited_transcript: str = None,
+    user_feedback: str = None,
+    original_text: str = None,
+):
     if not files:
         return None, None, None, "Please upload at least one PDF file before generating audio."
     try:
-        audio_file, transcript, original_text = generate_audio(*args)
+        audio_file, transcript, original_text = generate_audio(
+            files,
+            openai_api_key=openai_api_key,
+            text_model=text_model,
+            audio_model=audio_model,
+            speaker_1_voice=speaker_1_voice,
+            speaker_2_voice=speaker_2_voice,
+            api_base=api_base,
+            intro_instructions=intro_instructions,
+            text_instructions=text_instructions,
+            scratch_pad_instructions=scratch_pad_instructions,
+            prelude_dialog=prelude_dialog,
+            podcast_dialog_instructions=podcast_dialog_instructions,
+            edited_transcript=edited_transcript,
+            user_feedback=user_feedback,
+            original_text=original_text,
+        )
         return audio_file, transcript, original_text, None  # Return None as the error when successful
     except Exception as e:
         # If an error occurs during generation, return None for the outputs and the error message
@@ -29,7 +29,6 @@ from loguru import logger
 from openai import OpenAI
 from promptic import llm
 from pydantic import BaseModel, ValidationError
-from pypdf import PdfReader
 from tenacity import retry, retry_if_exception_type
 
 import re
@@ -1,9 +1,12 @@
 # From Chat GPT this code shows how to process scaned vs. digital (layerd text) pdf and what packages
 # are needed to process them accordingly
 
+from loguru import logger
 from PyPDF2 import PdfReader
-from pdfminer.high_level import extract_text
+from pdfminer.high_level import extract_pages, extract_text
+from pdfminer.layout import LAParams, LTFigure, LTText
 from pathlib import Path
+from typing import Iterator
 import pytesseract
 from PIL import Image
 import io
@@ -41,36 +44,81 @@ def extract_text_from_pdf(pdf_path):
 
     if is_scanned_pdf(pdf_path):
         # Scanned PDF: Use OCR
-        print(f"'{pdf_path}' appears to be a scanned document. Using OCR for text extraction.")
+        logger.debug(f"'{pdf_path}' appears to be a scanned document. Using OCR for text extraction.")
         return extract_text_with_ocr(pdf_path)
     else:
         # Digital PDF: Use direct text extraction
-        print(f"'{pdf_path}' appears to be a digital document. Extracting text directly.")
+        logger.debug(f"'{pdf_path}' appears to be a digital document. Extracting text directly.")
         return extract_text(pdf_path)
 
 def extract_text_with_ocr(pdf_path):
     """
     Extracts text from a scanned PDF using OCR (Tesseract).
     """
+    return "".join(iter_ocr_pages(pdf_path))
+
+def iter_ocr_pages(pdf_path) -> Iterator[str]:
+    """
+    Yields the OCR text of a scanned PDF one page at a time.
+    """
     reader = PdfReader(pdf_path)
-    text = ""
     for page in reader.pages:
-        if '/XObject' in page['/Resources']:
-            x_objects = page['/Resources']['/XObject'].get_object()
-            for obj in x_objects.values():
-                if obj['/Subtype'] == '/Image':
-                    # Extract image data
-                    data = obj._data
-                    image = Image.open(io.BytesIO(data))
+        yield ocr_page(page)
+
+def ocr_page(page):
+    """
+    Extracts text from the images on a single PDF page using OCR (Tesseract).
+    """
+    text = ""
+    if '/XObject' in page['/Resources']:
+        x_objects = page['/Resources']['/XObject'].get_object()
+        for obj in x_objects.values():
+            if obj['/Subtype'] == '/Image':
+                # Extract image data
+                data = obj._data
+                with Image.open(io.BytesIO(data)) as image:
                     # Use pytesseract to extract text from the image
                     text += pytesseract.image_to_string(image)
+    return text
 
+def layout_text(layout) -> str:
+    """
+    Collects the text of a pdfminer layout element, descending into figures.
+    Text drawn inside Form XObjects ends up in LTFigure elements rather than at the top level of the page.
+    """
+    text = ""
+    for element in layout:
+        if isinstance(element, LTText):
+            text += element.get_text()
+        elif isinstance(element, LTFigure):
+            text += layout_text(element)
     return text
 
+def iter_pages(pdf_path) -> Iterator[str]:
+    """
+    Yields the text of a PDF one page at a time, so large documents never have to be held as a single string.
+    Pages without a text layer are OCR'd individually instead of classifying the whole document up front,
+    so the PDF is only parsed once.
+    """
+    if not Path(pdf_path).is_file():
+        raise FileNotFoundError(f"No such file: '{pdf_path}'")
+
+    reader = None
+    # all_texts runs layout analysis inside figures too, so their text comes out as lines rather than loose characters
+    for page_number, page_layout in enumerate(extract_pages(pdf_path, laparams=LAParams(all_texts=True))):
+        text = layout_text(page_layout)
+        if not text.strip():
+            # No text layer on this page; it is likely scanned
+            reader = reader or PdfReader(pdf_path)
+            text = ocr_page(reader.pages[page_number])
+        yield text
+
 # Usage example
-pdf_files = ["document1.pdf", "document2.pdf"]  # List of PDF files to process
+if __name__ == "__main__":
+    pdf_files = ["document1.pdf", "document2.pdf"]  # List of PDF files to process
 
-for pdf_file in pdf_files:
-    extracted_text = extract_text_from_pdf(pdf_file)
-    print(f"Extracted text from '{pdf_file}':")
-    print(extracted_text)
+    for pdf_file in pdf_files:
+        print(f"Extracted text from '{pdf_file}':")
+        # Stream page by page rather than building the whole document's text first
+        for page_text in iter_pages(pdf_file):
+            print(page_text)
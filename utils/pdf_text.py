@@ -0,0 +1,22 @@
+# PyMuPDF text extraction for the app. Kept in its own module so PDF worker processes only need to import this.
+
+from pathlib import Path
+
+import fitz
+
+def pages_text(doc, start: int, stop: int) -> list:
+    """
+    Extracts the non-empty text of pages [start, stop) of an open PyMuPDF document.
+
+    Uses plain "text" mode in content-stream order (sort=False), the cheapest extraction mode. Sorting
+    by position or "blocks" mode preserves layout better but costs more, and the LLM only needs the
+    running text, which content-stream order gives well enough for typical papers.
+    """
+    return [text for text in (doc[i].get_text("text", sort=False) for i in range(start, stop)) if text]
+
+def extract_pages_text(path, start: int, stop: int) -> list:
+    """
+    Opens a PDF from its bytes and extracts the non-empty text of pages [start, stop).
+    """
+    with fitz.open(stream=Path(path).read_bytes(), filetype="pdf") as doc:
+        return pages_text(doc, start, stop)